@@ -117,6 +117,17 @@ Options:
     a better chance of missing packets during the brief error
     trapping time with a really short duration.
 
+    udp_rcvbuf = 1048576
+
+    The kernel receive buffer size (in bytes) to request for the
+    UDP socket.  The kernel default is often only a couple hundred
+    KB, which can drop packets when a burst of broadcasts arrives
+    while the host is busy.  Asking for 1MB smooths those bursts
+    out.  The kernel may cap the value lower than requested (see
+    net.core.rmem_max on Linux); the size actually granted is
+    written to syslog at startup.  Set to 0 to leave the kernel
+    default alone.
+
     share_socket = False
 
     Whether or not the UDP socket should be shared with other
@@ -143,7 +154,6 @@ for a Nobel Prize or something...
 """
 
 from __future__ import with_statement
-import math
 import time
 import weewx.units
 import weedb
@@ -153,12 +163,18 @@ import weewx.wxformulas
 from weeutil.weeutil import tobool
 import syslog
 import threading
+import functools
 
-import sys, getopt
-from socket import *
-import json
-from collections import namedtuple
-import datetime
+from socket import socket, AF_INET, SOCK_DGRAM, IPPROTO_UDP, SOL_SOCKET, SO_REUSEADDR, SO_RCVBUF
+import selectors
+
+# orjson decodes the raw datagram bytes a few times faster than the
+# stdlib json module.  It is optional; fall back to stdlib json when it
+# is not installed.  Both raise a ValueError subclass on bad input.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Default settings...
 DRIVER_VERSION = "1.10"
@@ -170,16 +186,33 @@ fields = dict()
 fields['obs_air'] = ('time_epoch', 'station_pressure', 'air_temperature', 'relative_humidity', 'lightning_strike_count', 'lightning_strike_avg_distance', 'battery', 'report_interval')
 fields['obs_sky'] = ('time_epoch', 'illuminance', 'uv', 'rain_accumulated', 'wind_lull', 'wind_avg', 'wind_gust', 'wind_direction', 'battery', 'report_interval', 'solar_radiation', 'local_day_rain_accumulation', 'precipitation_type', 'wind_sample_interval')
 fields['rapid_wind'] = ('time_epoch', 'wind_speed', 'wind_direction')
-fields['evt_precip'] = ('time_epoch')
+fields['evt_precip'] = ('time_epoch',)
 fields['evt_strike'] = ('time_epoch', 'distance', 'energy')
 fields['obs_st'] = ('time_epoch', 'wind_lull', 'wind_avg', 'wind_gust', 'wind_direction', 'wind_sample_interval', 'station_pressure', 'air_temperature', 'relative_humidity', 'illuminance', 'uv', 'solar_radiation', 'rain_accumulated', 'precipitation_type', 'lightning_strike_avg_distance', 'lightning_strike_count', 'battery', 'report_interval')
 
+# Observation packet dispatch: packet type -> (source key, whether the
+# values are nested one level down, field names).  One dict lookup
+# replaces the chain of per-type tests in parseUDPPacket.
+dispatch = dict()
+dispatch['obs_air'] = ('obs', True, fields['obs_air'])
+dispatch['obs_sky'] = ('obs', True, fields['obs_sky'])
+dispatch['obs_st'] = ('obs', True, fields['obs_st'])
+dispatch['rapid_wind'] = ('ob', False, fields['rapid_wind'])
+dispatch['evt_strike'] = ('evt', False, fields['evt_strike'])
+dispatch['evt_precip'] = ('evt', False, fields['evt_precip'])
+
+# Cache of fully-built "<field>.<serial>.<type>" key tuples, keyed by
+# (packet type, packet label).  A station repeats the same few labels
+# forever, so after the first packet of each type the per-field string
+# concatenation is gone from the receive path.
+label_cache = dict()
+
 def loader(config_dict, engine):
     return WeatherFlowUDPDriver(**config_dict[DRIVER_NAME])
 
 def logmsg(level, msg):
     syslog.syslog(level, 'weatherflowudp: %s: %s' %
-                  (threading.currentThread().getName(), msg))
+                  (threading.current_thread().name, msg))
 
 def logdbg(msg):
     logmsg(syslog.LOG_DEBUG, msg)
@@ -190,78 +223,79 @@ def loginf(msg):
 def logerr(msg):
     logmsg(syslog.LOG_ERR, msg)
 
-def sendMyLoopPacket(pkt,sensor_map):
+def buildReverseSensorMap(sensor_map):
+    # Invert the sensor map once so the per-packet pass is a plain dict
+    # lookup per parsed field.  A single label may feed several weewx
+    # fields (e.g. battery mapped to both outTempBatteryStatus and
+    # windBatteryStatus), so each normalized label keeps a tuple of
+    # weewx field names.
+    reverse_map = dict()
+    for pkt_weewx, pkt_label in sensor_map.items():
+        pkt_field = pkt_label.replace("-","_")
+        reverse_map[pkt_field] = reverse_map.get(pkt_field, ()) + (pkt_weewx,)
+    return reverse_map
+
+@functools.lru_cache(maxsize=64)
+def normalizeSerial(serial_number):
+    # A station only ever broadcasts a handful of serial numbers, so
+    # after the first packet from each device this is a cache hit
+    # instead of a string scan.
+    return serial_number.replace("-","_")
+
+def sendMyLoopPacket(pkt,reverse_map):
     packet = dict()
     if 'time_epoch' in pkt:
         packet = {'dateTime': pkt['time_epoch'],
             # weewx.METRICWX = mm/mps ; weewx.METRIC = cm/kph
             'usUnits' : weewx.METRICWX}
 
-    #for pkt_weewx, pkt_label in sensor_map.iteritems():     # Python 2
-    for pkt_weewx, pkt_label in list(sensor_map.items()):    # Python 3
-        if pkt_label.replace("-","_") in pkt:
-           packet[pkt_weewx] = pkt[pkt_label.replace("-","_")]
+    for pkt_field, pkt_value in pkt.items():
+        for pkt_weewx in reverse_map.get(pkt_field, ()):
+            packet[pkt_weewx] = pkt_value
 
     return packet
 
-def parseUDPPacket(pkt):
+def parseUDPPacket(pkt, sensor_labels=None):
+    # When sensor_labels is given, only the fields it names (plus
+    # time_epoch) are emitted, so the driver never builds the full
+    # <field>.<serial>.<type> cross-product for fields no sensor map
+    # entry will ever read.  Pass None to get every field, e.g. for
+    # examining what a sensor sends.
     packet = dict()
     if 'serial_number' in pkt:
         if 'type' in pkt:
-            serial_number = pkt['serial_number'].replace("-","_")
+            serial_number = normalizeSerial(pkt['serial_number'])
             pkt_type = pkt['type']
             pkt_label = serial_number + "." + pkt_type
-            #pkt_keys = pkt.keys()         # Python 2
-            pkt_keys = list(pkt.keys())    # Python 3
-            for i in pkt_keys:
-                pkt_item = i + "." + pkt_label
-                packet[pkt_item] = pkt[i]
-
-            if pkt_type == 'obs_air':
-                packet['time_epoch'] = pkt['obs'][0][0]
-                for i1, obs_val in enumerate(pkt['obs'][0]):
-                    pkt_item1 =  fields['obs_air'][i1] + "." + pkt_label
-                    packet[pkt_item1] = obs_val
-
-            if pkt_type == 'obs_sky':
-                packet['time_epoch'] = pkt['obs'][0][0]
-                for i1, obs_val in enumerate(pkt['obs'][0]):
-                    pkt_item1 =  fields['obs_sky'][i1] + "." + pkt_label
-                    packet[pkt_item1] = obs_val
-
-            if pkt_type == 'obs_st':
-                packet['time_epoch'] = pkt['obs'][0][0]
-                for i1, obs_val in enumerate(pkt['obs'][0]):
-                    pkt_item1 =  fields['obs_st'][i1] + "." + pkt_label
-                    packet[pkt_item1] = obs_val
-
-            if pkt_type == 'rapid_wind':
-                packet['time_epoch'] = pkt['ob'][0]
-                for i1, obs_val in enumerate(pkt['ob']):
-                    pkt_item1 =  fields['rapid_wind'][i1] + "." + pkt_label
-                    packet[pkt_item1] = obs_val
-
-            if pkt_type == 'evt_strike':
-                packet['time_epoch'] = pkt['evt'][0]
-                for i1, obs_val in enumerate(pkt['evt']):
-                    pkt_item1 =  fields['evt_strike'][i1] + "." + pkt_label
-                    packet[pkt_item1] = obs_val
-
-            if pkt_type == 'evt_precip':
-                packet['time_epoch'] = pkt['evt'][0]
-                for i1, obs_val in enumerate(pkt['evt']):
-                    pkt_item1 =  fields['evt_precip'][i1] + "." + pkt_label
-                    packet[pkt_item1] = obs_val
-
-            if pkt_type == 'device_status':
+            pkt_suffix = "." + pkt_label
+            for i, pkt_val in pkt.items():
+                pkt_item = i + pkt_suffix
+                if sensor_labels is None or pkt_item in sensor_labels:
+                    packet[pkt_item] = pkt_val
+
+            entry = dispatch.get(pkt_type)
+            if entry is not None:
+                source_key, nested, field_names = entry
+                obs_vals = pkt[source_key][0] if nested else pkt[source_key]
+                packet['time_epoch'] = obs_vals[0]
+                cache_key = (pkt_type, pkt_label)
+                pkt_items = label_cache.get(cache_key)
+                if pkt_items is None:
+                    pkt_items = tuple(field_name + "." + pkt_label for field_name in field_names)
+                    label_cache[cache_key] = pkt_items
+                for pkt_item1, obs_val in zip(pkt_items, obs_vals):
+                    if sensor_labels is None or pkt_item1 in sensor_labels:
+                        packet[pkt_item1] = obs_val
+
+            elif pkt_type == 'device_status' or pkt_type == 'hub_status':
                 packet['time_epoch'] = pkt['timestamp']
 
-            if pkt_type == 'hub_status':
-                packet['time_epoch'] = pkt['timestamp']
-
-            if pkt_type[0:2] == 'X_':
+            elif pkt_type[0:2] == 'X_':
                 packet['time_epoch'] = int(time.time())
 
+            else:
+                logdbg('Unknown packet type %s from %s' % (pkt_type, pkt['serial_number']))
+
         else:
             loginf('Corrupt UDP packet? %s' % pkt)
     else:
@@ -277,12 +311,26 @@ class WeatherFlowUDPDriver(weewx.drivers.AbstractDevice):
         self._udp_address = stn_dict.get('udp_address', '<broadcast>')
         self._udp_port = int(stn_dict.get('udp_port', 50222))
         self._udp_timeout = int(stn_dict.get('udp_timeout', 90))
+        self._udp_rcvbuf = int(stn_dict.get('udp_rcvbuf', 1048576))
         self._share_socket = tobool(stn_dict.get('share_socket', False))
         self._sensor_map = stn_dict.get('sensor_map', {})
+        # The sensor map is static, so invert it once here rather than
+        # walking it (and re-normalizing its labels) for every packet.
+        self._reverse_map = buildReverseSensorMap(self._sensor_map)
+        # Packets that carry none of the mapped fields (hub_status,
+        # device_status, unmapped serials) can skip the mapping pass
+        # entirely.
+        self._sensor_labels = set(self._reverse_map)
+        # The packet types the sensor map can ever use, as quoted byte
+        # strings.  A substring scan of the raw datagram for one of
+        # these is far cheaper than JSON-parsing packet types that are
+        # never mapped (hub_status, device_status, ...).
+        self._type_probes = tuple(
+            ('"%s"' % pkt_type).encode()
+            for pkt_type in set(pkt_label.rsplit(".",1)[-1] for pkt_label in self._sensor_map.values()))
         loginf('sensor map is %s' % self._sensor_map)
         loginf('*** Sensor names per packet type')
-        #for pkt_type in fields.keys():                  # Python 2
-        for pkt_type in list(fields.keys()):             # Python 3
+        for pkt_type in fields:
             loginf('packet %s: %s' % (pkt_type,fields[pkt_type]))
 
     @property
@@ -296,31 +344,71 @@ class WeatherFlowUDPDriver(weewx.drivers.AbstractDevice):
         s=socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP)
         if self._share_socket == True:
             s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self._udp_rcvbuf > 0:
+            # Ask the kernel for a larger receive buffer so packet bursts
+            # are not dropped while the driver is busy.  The kernel may
+            # grant less than requested, so log what we actually got.
+            s.setsockopt(SOL_SOCKET, SO_RCVBUF, self._udp_rcvbuf)
+            loginf('UDP receive buffer size is %s' % s.getsockopt(SOL_SOCKET, SO_RCVBUF))
         s.bind((self._udp_address,self._udp_port))
-        s.settimeout(self._udp_timeout)
+        # The socket stays non-blocking for its whole life; the selector
+        # below supplies the receive timeout, so the loop no longer flips
+        # blocking mode around every burst.
+        s.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(s, selectors.EVENT_READ)
+
+        # One MTU-sized receive buffer reused for every datagram, rather
+        # than a fresh bytes object and address tuple per recvfrom call.
+        rxbuf = bytearray(1500)
+        rxview = memoryview(rxbuf)
+
+        # Bind the per-packet callables and instance attributes as locals
+        # so the receive loop uses fast local lookups instead of
+        # attribute/global lookups.
+        recv_into = s.recv_into
+        loads = json_loads
+        parse = parseUDPPacket
+        send_loop = sendMyLoopPacket
+        log_raw_packets = self._log_raw_packets
+        sensor_labels = self._sensor_labels
+        reverse_map = self._reverse_map
+        udp_timeout = self._udp_timeout
+        type_probes = self._type_probes
 
         while True:
-            timeouterr=0
-            try:
-                m=s.recvfrom(1024)
-            except timeout:
-                timeouterr=1
+            raw_packets = []
+            if sel.select(udp_timeout):
+                # Packets often arrive in bursts (rapid_wind plus an
+                # observation plus status packets back to back), so once
+                # the socket is readable drain everything queued and
+                # process the whole batch in one pass.
+                while True:
+                    try:
+                        n = recv_into(rxbuf)
+                        raw_packets.append(rxview[:n].tobytes())
+                    except BlockingIOError:
+                        break
+            else:
                 logerr('Socket timeout waiting for incoming UDP packet!')
-            if timeouterr == 0:
-                try:
-                    m0 = str(m[0],'utf-8').replace(",null",",None")    # Python 3
-                except:
-                    m0 = m[0].replace(",null",",None")                 # Python 2
+            for m0 in raw_packets:
+                # Unless raw logging wants every packet, drop datagrams
+                # whose type can never match the sensor map before paying
+                # for the JSON parse.  bytes.__contains__ is a C-level
+                # substring scan.
+                if not log_raw_packets and not any(probe in m0 for probe in type_probes):
+                    continue
                 m1=''
                 try:
-                    m1=eval(m0)
-                except SyntaxError:
+                    m1=loads(m0)
+                except ValueError:
                     logerr('Packet parse error: %s' % m0)
-                if self._log_raw_packets:
+                if log_raw_packets:
                     loginf('raw packet: %s' % m1)
-                m2=parseUDPPacket(m1)
-                m3=sendMyLoopPacket(m2, self._sensor_map)
-                if len(m3) > 2:
-                    yield m3
+                m2=parse(m1, sensor_labels)
+                if m2.keys() & sensor_labels:
+                    m3=send_loop(m2, reverse_map)
+                    if len(m3) > 2:
+                        yield m3
 
 
@@ -6,15 +6,9 @@
 # https://raw.githubusercontent.com/poblabs/weewx-belchertown/master/install.py
 # Copyright Pat O'Brien
 
-import configobj
-from setup import ExtensionInstaller
+import functools
 
-try:
-    # Python 2
-    from StringIO import StringIO
-except ImportError:
-    # Python 3
-    from io import StringIO
+from setup import ExtensionInstaller
 
 #-------- extension info -----------
 
@@ -26,68 +20,76 @@ AUTHOR_EMAIL = "vreihen@yahoo.com"
 
 #-------- main loader -----------
 
+# weewx's extension machinery can call loader() more than once during
+# discovery; the installer takes no arguments, so cache the instance.
+@functools.lru_cache(maxsize=1)
 def loader():
     return WeatherFlowUDPInstaller()
 
 class WeatherFlowUDPInstaller(ExtensionInstaller):
     def __init__(self):
-        super(WeatherFlowUDPInstaller, self).__init__(
-            version=VERSION,
-            name=NAME,
-            description=DESCRIPTION,
-            author=AUTHOR,
-            author_email=AUTHOR_EMAIL,
-            config=config_dict,
-            files=files_dict
-        )
+        # installer_kwargs is assembled once at the bottom of the module,
+        # after the config and files stanzas it refers to.
+        super(WeatherFlowUDPInstaller, self).__init__(**installer_kwargs)
 
 #----------------------------------
 #         config stanza
 #----------------------------------
 
-extension_config = """
-
-[WeatherFlowUDP]
-
-    driver = user.weatherflowudp
-    log_raw_packets = False
-    udp_address = <broadcast>
-    # udp_address = 0.0.0.0
-    # udp_address = 255.255.255.255
-    udp_port = 50222
-    udp_timeout = 90
-    share_socket = False
-
-    #
-    # IMPORTANT - please edit in 'your' sensor ID below
-    #             (the value 'ST-00000025' here is an example only)
-    #
-
-    [[sensor_map]]
-        outTemp = air_temperature.ST-00000025.obs_st
-        outHumidity = relative_humidity.ST-00000025.obs_st
-        pressure = station_pressure.ST-00000025.obs_st
-        # lightning_strikes =  lightning_strike_count.ST-00000025.obs_st
-        # avg_distance =  lightning_strike_avg_distance.ST-00000025.obs_st
-        outTempBatteryStatus = battery.ST-00000025.obs_st
-        windSpeed = wind_speed.ST-00000025.rapid_wind
-        windDir = wind_direction.ST-00000025.rapid_wind
-        # luxXXX = illuminance.ST-00000025.obs_st
-        UV = uv.ST-00000025.obs_st
-        rain = rain_accumulated.ST-00000025.obs_st
-        windBatteryStatus = battery.ST-00000025.obs_st
-        radiation = solar_radiation.ST-00000025.obs_st
-        # lightningXXX = distance.ST-00000025.evt_strike
-        # lightningYYY = energy.ST-00000025.evt_strike
-
-"""
-config_dict = configobj.ConfigObj(StringIO(extension_config))
+# The config stanza is a plain nested dict rather than an INI string run
+# through configobj; ExtensionInstaller consumes it directly, so there is
+# nothing to parse at import time.
+#
+# IMPORTANT - please edit in 'your' sensor ID below
+#             (the value 'ST-00000025' here is an example only)
+#
+# Other observation_names available for the sensor_map include
+# lightning_strike_count, lightning_strike_avg_distance, illuminance,
+# and the evt_strike distance/energy fields - see the driver docstring.
+
+config_dict = {
+    'WeatherFlowUDP': {
+        'driver': 'user.weatherflowudp',
+        'log_raw_packets': 'False',
+        'udp_address': '<broadcast>',
+        # udp_address = 0.0.0.0
+        # udp_address = 255.255.255.255
+        'udp_port': '50222',
+        'udp_timeout': '90',
+        'share_socket': 'False',
+        'sensor_map': {
+            'outTemp': 'air_temperature.ST-00000025.obs_st',
+            'outHumidity': 'relative_humidity.ST-00000025.obs_st',
+            'pressure': 'station_pressure.ST-00000025.obs_st',
+            'outTempBatteryStatus': 'battery.ST-00000025.obs_st',
+            'windSpeed': 'wind_speed.ST-00000025.rapid_wind',
+            'windDir': 'wind_direction.ST-00000025.rapid_wind',
+            'UV': 'uv.ST-00000025.obs_st',
+            'rain': 'rain_accumulated.ST-00000025.obs_st',
+            'windBatteryStatus': 'battery.ST-00000025.obs_st',
+            'radiation': 'solar_radiation.ST-00000025.obs_st',
+        },
+    },
+}
 
 #----------------------------------
 #        files stanza
 #----------------------------------
-files=[('bin/user', ['bin/user/weatherflowudp.py'])]
-files_dict = files
+FILES = (('bin/user', ('bin/user/weatherflowudp.py',)),)
+
+#----------------------------------
+#       installer arguments
+#----------------------------------
+
+installer_kwargs = dict(
+    version=VERSION,
+    name=NAME,
+    description=DESCRIPTION,
+    author=AUTHOR,
+    author_email=AUTHOR_EMAIL,
+    config=config_dict,
+    files=FILES,
+)
 
 #---------------------------------
 #          done